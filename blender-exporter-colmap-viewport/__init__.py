@@ -3,12 +3,24 @@ from pathlib import Path
 import mathutils
 from .ext.read_write_model import write_model, Camera, Image  # Corrected import
 from bpy_extras.io_utils import ExportHelper
-from bpy.props import StringProperty, FloatProperty
+from bpy.props import StringProperty, FloatProperty, IntProperty
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import bpy
+import gpu
 import json
 import math
 import os
+import queue
+import struct
 import subprocess
+import threading
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 bl_info = {
     "name": "Scene Exporter for NeRF with Viewport Rendering",
@@ -23,13 +35,68 @@ bl_info = {
     "category": "Import-Export"
 }
 
-def get_coord_conversion_matrix():
+# Coordinate system conversion matrix: a -90 degree rotation around the X-axis
+# converting Blender's Z-up to COLMAP/NeRF's Y-up
+COORD_CONV = np.array([
+    [1, 0, 0, 0],
+    [0, 0, 1, 0],
+    [0, -1, 0, 0],
+    [0, 0, 0, 1],
+], dtype=np.float64)
+
+# Shared read-only placeholders for images without 2D-3D correspondences
+_EMPTY_XYS = np.empty((0, 2), dtype=np.float64)
+_EMPTY_XYS.setflags(write=False)
+_EMPTY_PIDS = np.empty((0,), dtype=np.int64)
+_EMPTY_PIDS.setflags(write=False)
+
+def _png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+# PNG color types for Blender's image color modes, and Rec. 709 luma weights for BW
+_PNG_COLOR_TYPES = {'BW': 0, 'RGB': 2, 'RGBA': 6}
+_LUMA_WEIGHTS = np.array([0.2126, 0.7152, 0.0722])
+
+def _save_png(path, pixels, width, height, color_mode, compress_level):
+    """
+    Encodes an RGBA8 pixel array (bottom row first, as read back from the GPU) into an 8-bit PNG
+    with the given Blender color mode ('BW', 'RGB' or 'RGBA').
+    zlib releases the GIL while compressing, so this can run on a worker thread.
+    """
+    # Flip to top-down rows and keep only the channels the color mode asks for
+    rows = pixels.reshape(height, width, 4)[::-1]
+    if color_mode == 'RGBA':
+        data = rows
+    elif color_mode == 'BW':
+        data = np.rint(rows[..., :3] @ _LUMA_WEIGHTS).astype(np.uint8)
+    else:
+        data = rows[..., :3]
+    data = np.ascontiguousarray(data).reshape(height, -1)
+
+    # Apply the Up filter (type 2): every byte minus the byte above it, modulo 256
+    scanlines = np.empty((height, data.shape[1] + 1), dtype=np.uint8)
+    scanlines[:, 0] = 2
+    scanlines[0, 1:] = data[0]
+    np.subtract(data[1:], data[:-1], out=scanlines[1:, 1:])
+
+    color_type = _PNG_COLOR_TYPES.get(color_mode, 2)
+    header = struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(_png_chunk(b'IHDR', header))
+        f.write(_png_chunk(b'IDAT', zlib.compress(scanlines.tobytes(), compress_level)))
+        f.write(_png_chunk(b'IEND', b''))
+
+def _dumps_json(obj, indent=False):
     """
-    Defines the coordinate system conversion matrix.
-    Rotates -90 degrees around the X-axis to convert Blender's Z-up to COLMAP/NeRF's Y-up.
+    Serializes obj to JSON bytes, using orjson when it is installed.
     """
-    rot = mathutils.Euler((-math.pi / 2, 0, 0), 'XYZ').to_matrix().to_4x4()
-    return rot
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, indent=2 if indent else None).encode()
 
 class BlenderExporterForNeRF(bpy.types.Operator, ExportHelper):
     bl_idname = "export_scene.nerf_dataset"
@@ -46,11 +113,20 @@ class BlenderExporterForNeRF(bpy.types.Operator, ExportHelper):
     p1: FloatProperty(name="P1", default=0.0)
     p2: FloatProperty(name="P2", default=0.0)
     aabb_scale: FloatProperty(name="AABB Scale", default=16.0)
+    png_compress_level: IntProperty(name="PNG Compression", default=3, min=0, max=9)
+    # 0 keeps the scene's own resolution percentage
+    resolution_pct: IntProperty(name="Resolution %", default=0, min=0, max=100)
 
     def execute(self, context):
         dirpath = Path(self.directory)
         format = '.json'  # Changed to JSON format
 
+        # Export at the requested resolution, restoring the scene setting afterwards
+        render = context.scene.render
+        old_resolution_pct = render.resolution_percentage
+        if self.resolution_pct:
+            render.resolution_percentage = self.resolution_pct
+
         # Initialize the export process
         try:
             for progress in self.export_dataset(context, dirpath, format):
@@ -59,6 +135,8 @@ class BlenderExporterForNeRF(bpy.types.Operator, ExportHelper):
         except Exception as e:
             self.report({'ERROR'}, f"Export failed: {e}")
             return {'CANCELLED'}
+        finally:
+            render.resolution_percentage = old_resolution_pct
 
         self.report({'INFO'}, "Export completed successfully.")
         return {'FINISHED'}
@@ -85,8 +163,8 @@ class BlenderExporterForNeRF(bpy.types.Operator, ExportHelper):
             return {'CANCELLED'}
 
         cam = scene_cameras[0]
-        width = scene.render.resolution_x
-        height = scene.render.resolution_y
+        width = scene.render.resolution_x * scene.render.resolution_percentage // 100
+        height = scene.render.resolution_y * scene.render.resolution_percentage // 100
         focal_length = cam.data.lens
         sensor_width = cam.data.sensor_width
         sensor_height = cam.data.sensor_height
@@ -113,138 +191,257 @@ class BlenderExporterForNeRF(bpy.types.Operator, ExportHelper):
             "cy": cy,
             "w": width,
             "h": height,
-            "aabb_scale": self.aabb_scale,
-            "frames": []
+            "aabb_scale": self.aabb_scale
         }
 
-        # Define coordinate conversion matrix
-        coord_conv = get_coord_conversion_matrix()
-
-        # Proceed with exporting each camera/frame
-        for idx, cam in enumerate(sorted(scene_cameras, key=lambda x: x.name_full)):
-            filename = f'frame_{idx:05d}.png'
-            file_path = images_dir / filename
-
-            image_id = idx + 1
-
-            # Extract camera's world matrix
-            cam_matrix = cam.matrix_world.copy()
-
-            # Apply coordinate conversion
-            transformed_matrix = coord_conv @ cam_matrix
-
-            # Extract rotation and translation from the transformed matrix
-            rotation_euler = transformed_matrix.to_euler('XYZ')
-            rotation_matrix = rotation_euler.to_matrix()
-            translation = transformed_matrix.to_translation()
-
-            # Convert rotation matrix to quaternion
-            cam_rot = rotation_matrix.to_quaternion()
-            qw, qx, qy, qz = cam_rot.w, cam_rot.x, cam_rot.y, cam_rot.z
-
-            # Translation vector
-            T1 = translation
-
-            # Add camera to model
-            cameras[image_id] = Camera(
-                id=image_id,
-                model='OPENCV',  # Can be changed if needed
-                width=width,
-                height=height,
-                params=[fx, fy, cx, cy, k1, k2, p1, p2]
-            )
-
-            images[image_id] = Image(
-                id=image_id,
-                qvec=np.array([qw, qx, qy, qz]),
-                tvec=np.array([T1[0], T1[1], T1[2]]),
-                camera_id=image_id,
-                name=filename,
-                xys=[],
-                point3D_ids=[]
-            )
-
-            # Set the scene camera
-            scene.camera = cam
-
-            # Set the render filepath
-            scene.render.filepath = str(file_path)
-
-            # Find the VIEW_3D area and region once
-            view3d_area = None
-            view3d_region = None
-            view3d_space = None
-            window = None
-            for window in bpy.context.window_manager.windows:
-                for area in window.screen.areas:
-                    if area.type == 'VIEW_3D':
-                        view3d_area = area
-                        for region in area.regions:
-                            if region.type == 'WINDOW':
-                                view3d_region = region
-                                break
-                        for space in area.spaces:
-                            if space.type == 'VIEW_3D':
-                                view3d_space = space
-                                break
-                        break
-                if view3d_area and view3d_region and view3d_space:
+        # Find the VIEW_3D area and region once
+        view3d_area = None
+        view3d_region = None
+        view3d_space = None
+        window = None
+        for window in bpy.context.window_manager.windows:
+            for area in window.screen.areas:
+                if area.type == 'VIEW_3D':
+                    view3d_area = area
+                    for region in area.regions:
+                        if region.type == 'WINDOW':
+                            view3d_region = region
+                            break
+                    for space in area.spaces:
+                        if space.type == 'VIEW_3D':
+                            view3d_space = space
+                            break
                     break
+            if view3d_area and view3d_region and view3d_space:
+                break
+
+        if not (view3d_area and view3d_region and view3d_space):
+            self.report({'ERROR'}, "No 3D Viewport area found")
+            return {'CANCELLED'}
+
+        # Set up the context override
+        override = {
+            'window': window,
+            'screen': window.screen,
+            'area': view3d_area,
+            'region': view3d_region,
+            'scene': scene,
+        }
 
-            if not (view3d_area and view3d_region and view3d_space):
-                self.report({'ERROR'}, "No 3D Viewport area found")
-                return {'CANCELLED'}
-
-            # Set up the context override
-            override = {
-                'window': window,
-                'screen': window.screen,
-                'area': view3d_area,
-                'region': view3d_region,
-                'scene': scene,
-            }
-
-            with bpy.context.temp_override(**override):
-                # Set the viewport's camera to the current camera
-                view3d_space.camera = cam
-                view3d_space.region_3d.view_perspective = 'CAMERA'
-
-                # Refresh the context to update the viewport
-                bpy.context.view_layer.update()
-
-                # Optionally set viewport shading to 'RENDERED' for better visuals
-                view3d_space.shading.type = 'RENDERED'
-
-                # Render the viewport and save the image
-                bpy.ops.render.opengl(write_still=True)
-
-            # Append frame information for transforms.json
-            frame = {
-                "file_path": f"./images/{filename}",
-                "transform_matrix": [
-                    [
-                        rotation_matrix[0][0], rotation_matrix[0][1], rotation_matrix[0][2], T1[0]
-                    ],
-                    [
-                        rotation_matrix[1][0], rotation_matrix[1][1], rotation_matrix[1][2], T1[1]
-                    ],
-                    [
-                        rotation_matrix[2][0], rotation_matrix[2][1], rotation_matrix[2][2], T1[2]
-                    ],
-                    [0, 0, 0, 1]
-                ]
-            }
-            transforms["frames"].append(frame)
-
-            yield 100.0 * (idx + 1) / len(scene_cameras)
-
-        # Write camera poses to JSON
-        write_model(cameras, images, {}, str(poses_dir), format)
-
-        # Write transforms.json with the desired structure
-        transforms_path = output_dir / 'transforms.json'
-        with transforms_path.open('w') as f:
-            json.dump(transforms, f, indent=4)
+        with bpy.context.temp_override(**override):
+            view3d_space.region_3d.view_perspective = 'CAMERA'
+
+            # Optionally set viewport shading to 'RENDERED' for better visuals.
+            # Done once, since every assignment rebuilds the render engine
+            view3d_space.shading.type = 'RENDERED'
+
+        # Apply the coordinate conversion to all camera world matrices at once.
+        # Object scale is normalized away so the exported rotations stay orthonormal
+        cams = tuple(sorted(scene_cameras, key=lambda x: x.name_full))
+        n_cams = len(cams)
+        world = np.stack([np.array(c.matrix_world.normalized(), dtype=np.float64) for c in cams])
+        transformed = COORD_CONV @ world
+
+        depsgraph = context.evaluated_depsgraph_get()
+
+        # PNG encoding runs in the background so it overlaps with the next viewport render.
+        # At most png_max_pending frames wait for encoding, bounding their pixel buffers in memory
+        png_workers = os.cpu_count() or 1
+        png_max_pending = 2 * png_workers
+        png_futures = deque()
+
+        # Engines run by the draw manager render all of their samples in one offscreen draw;
+        # others (e.g. Cycles) go through the viewport render operator, which runs to completion
+        use_offscreen = scene.render.engine in {'BLENDER_EEVEE', 'BLENDER_EEVEE_NEXT', 'BLENDER_WORKBENCH'}
+        image_settings = scene.render.image_settings
+        old_image_settings = (
+            image_settings.file_format,
+            image_settings.color_mode,
+            image_settings.color_depth,
+            image_settings.compression,
+        )
+        if not use_offscreen:
+            image_settings.file_format = 'PNG'
+            image_settings.compression = math.ceil(self.png_compress_level * 100 / 9)
+
+        # Poses, model entries and frames are built on a worker thread while
+        # the main thread keeps rendering; a None item ends the queue
+        pose_queue = queue.Queue()
+        pose_errors = []
+
+        def pose_worker(frames_file):
+            while True:
+                item = pose_queue.get()
+                if item is None:
+                    return
+                if pose_errors:
+                    continue
+                idx, image_id, filename = item
+                try:
+                    # Extract rotation and translation from the transformed matrix
+                    transformed_matrix = transformed[idx]
+                    rot3 = transformed_matrix[:3, :3]
+
+                    # Convert the rotation matrix to a quaternion
+                    cam_rot = mathutils.Matrix(rot3).to_quaternion()
+
+                    # Translation vector
+                    T1 = transformed_matrix[:3, 3]
+
+                    # Add camera to model
+                    cameras[image_id] = Camera(
+                        id=image_id,
+                        model='OPENCV',  # Can be changed if needed
+                        width=width,
+                        height=height,
+                        params=[fx, fy, cx, cy, k1, k2, p1, p2]
+                    )
+
+                    images[image_id] = Image(
+                        id=image_id,
+                        # Quaternion sequences are ordered (w, x, y, z) like COLMAP's qvec
+                        qvec=np.asarray(cam_rot, dtype=np.float64),
+                        tvec=np.asarray(T1, dtype=np.float64),
+                        camera_id=image_id,
+                        name=filename,
+                        xys=_EMPTY_XYS,
+                        point3D_ids=_EMPTY_PIDS
+                    )
+
+                    # Append frame information for transforms.json
+                    frame = {
+                        "file_path": f"./images/{filename}",
+                        "transform_matrix": transformed_matrix.tolist()
+                    }
+                    frames_file.write(_dumps_json(frame) + b'\n')
+                except Exception as e:
+                    pose_errors.append(e)
+
+        # Frames are streamed to a sidecar file instead of being kept in memory
+        frames_path = poses_dir / '_frames.ndjson'
+        frames_file = None
+        pose_thread = None
+        offscreen = None
+
+        try:
+            # Offscreen buffer the viewport is drawn into, shared by all frames
+            if use_offscreen:
+                offscreen = gpu.types.GPUOffscreen(width, height)
+            frames_file = frames_path.open('wb')
+            pose_thread = threading.Thread(target=pose_worker, args=(frames_file,), daemon=True)
+            pose_thread.start()
+
+            with ThreadPoolExecutor(max_workers=png_workers) as png_pool:
+                # Image paths are built by string concatenation instead of Path joins
+                images_dir_str = os.fspath(images_dir) + os.sep
+
+                # Proceed with exporting each camera/frame
+                for idx, cam in enumerate(cams):
+                    filename = f'frame_{idx:05d}.png'
+                    filepath_str = f"{images_dir_str}{filename}"
+
+                    # Stop early if building a pose failed
+                    if pose_errors:
+                        raise pose_errors[0]
+
+                    image_id = idx + 1
+                    pose_queue.put((idx, image_id, filename))
+
+                    # Set the viewport's camera to the current camera; the draw engine takes
+                    # camera object settings such as depth of field from it
+                    view3d_space.camera = cam
+
+                    if not use_offscreen:
+                        # The viewport render operator draws through the scene camera as well
+                        scene.camera = cam
+                        scene.render.filepath = filepath_str
+                        with bpy.context.temp_override(**override):
+                            # Render the viewport and save the image
+                            bpy.ops.render.opengl(write_still=True)
+                    else:
+                        # Draw the viewport from this camera into the offscreen buffer and read the
+                        # pixels back. The projection comes from this camera's own lens, sensor,
+                        # shift and clipping
+                        view_matrix = cam.matrix_world.normalized().inverted()
+                        projection_matrix = cam.calc_matrix_camera(
+                            depsgraph,
+                            x=width,
+                            y=height,
+                            scale_x=scene.render.pixel_aspect_x,
+                            scale_y=scene.render.pixel_aspect_y
+                        )
+                        offscreen.draw_view3d(
+                            scene,
+                            context.view_layer,
+                            view3d_space,
+                            view3d_region,
+                            view_matrix,
+                            projection_matrix,
+                            do_color_management=True
+                        )
+                        with offscreen.bind():
+                            framebuffer = gpu.state.active_framebuffer_get()
+                            buffer = framebuffer.read_color(0, 0, width, height, 4, 0, 'UBYTE')
+                        pixels = np.asarray(buffer, dtype=np.uint8)
+
+                        # Wait for the oldest frame once the encoding backlog is full
+                        if len(png_futures) >= png_max_pending:
+                            png_futures.popleft().result()
+
+                        # Save the image on a worker thread
+                        png_futures.append(
+                            png_pool.submit(
+                                _save_png,
+                                filepath_str,
+                                pixels,
+                                width,
+                                height,
+                                image_settings.color_mode,
+                                self.png_compress_level
+                            )
+                        )
+
+                    yield 100.0 * (idx + 1) / n_cams
+
+                pose_queue.put(None)
+                pose_thread.join()
+                frames_file.close()
+                if pose_errors:
+                    raise pose_errors[0]
+
+                # Wait for all images to be written, re-raising any encoding error
+                for future in png_futures:
+                    future.result()
+
+            # Write camera poses to JSON
+            write_model(cameras, images, {}, str(poses_dir), format)
+
+            # Write transforms.json with the desired structure
+            # by stitching the streamed frames in after the header fields
+            transforms_path = output_dir / 'transforms.json'
+            header = _dumps_json(transforms, indent=True)
+            with transforms_path.open('wb') as f, frames_path.open('rb') as frames:
+                f.write(header[:-1].rstrip() + b',\n  "frames": [')
+                for i, line in enumerate(frames):
+                    f.write((b',\n    ' if i else b'\n    ') + line.rstrip(b'\n'))
+                f.write(b'\n  ]\n}\n')
+        finally:
+            # Release everything even if rendering or writing failed part way
+            if pose_thread is not None and pose_thread.is_alive():
+                pose_queue.put(None)
+                pose_thread.join()
+            if frames_file is not None:
+                frames_file.close()
+            frames_path.unlink(missing_ok=True)
+            if offscreen is not None:
+                offscreen.free()
+            # The format goes first, since changing it can reset the color mode and depth
+            (
+                image_settings.file_format,
+                image_settings.color_mode,
+                image_settings.color_depth,
+                image_settings.compression,
+            ) = old_image_settings
 
         return {'FINISHED'}
 